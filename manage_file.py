@@ -1,42 +1,552 @@
+import io
+import os
+import json
+import time
+import hashlib
+import tempfile
+import codecs
+import logging
+import threading
 import requests
+import numpy as np
 import pandas as pd
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from rainwater_drainage_calculations import calculations as pipe
 
+logger = logging.getLogger(__name__)
 
-def insert_excel_data(path):
-    data = pd.read_excel(path)
-    df = pd.DataFrame(data)
-    df.rename(columns=df.iloc[0]).drop(df.index[0])
+
+
+def user_cache_dir():
+    """Return the per-user cache directory of the package, e.g. ~/.cache/rainwater_drainage_calculations."""
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'rainwater_drainage_calculations')
+
+
+CACHE_DIR = user_cache_dir()
+DOWNLOAD_TTL = 3600
+DOWNLOAD_TIMEOUT = 30
+ENCODING_PREFIX = 1 << 20
+
+PIPE_SCHEMA = {
+    'Flow [l/s]': np.float64,
+    'Land elevation  [m]': np.float64,
+    'Channel bottom [m]': np.float64,
+    'Diameter [m]': np.float64,
+    'pipe dip [m]': np.float64,
+    'Length [m]': np.float64,
+    'slope [‰]': np.float64,
+}
+
+PIPE_SETTINGS_SCHEMA = {
+    'diameter': np.float64,
+    'min_slope': np.float64,
+    'max_slope': np.float64,
+    'max_filling': np.float64,
+    'max_velocity': np.float64,
+}
+
+
+def file_hash(path):
+    """
+    Calculate the content hash of a file.
+
+    Args:
+        path (str): path to the file
+
+    Return:
+        hash (str): sha256 hex digest of the file content
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def coerce_schema(df, schema):
+    """
+    Convert the columns listed in schema to their dtype. Values which cannot be converted become NaN.
+    Columns missing from the table are left out.
+
+    Args:
+        df (pd.DataFrame): table to convert in place
+        schema (dict): mapping of column name to numpy dtype
+
+    Return:
+        df (pd.DataFrame): converted table
+    """
+    for column, dtype in schema.items():
+        if column in df.columns:
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype(dtype)
     return df
 
 
-def insert_excel_pipe_settings(path):
-    data = pd.read_excel(path)
-    df = pd.DataFrame(data)
-    df.rename(columns=df.iloc[0]).drop(df.index[0])
+def detect_encoding(path, limit=None):
+    """
+    Detect the encoding of a CSV file. The file is decoded block by block, so it is never held in memory.
+
+    Args:
+        path (str): path to the CSV file
+        limit (int): number of bytes to check, the whole file by default
+
+    Return:
+        encoding (str): 'utf-8-sig' for valid UTF-8 files, 'unicode_escape' otherwise
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    read = 0
+    try:
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                decoder.decode(block[:limit - read] if limit is not None else block)
+                read += len(block)
+                if limit is not None and read >= limit:
+                    # a character may be cut at the limit, so the decoder is not finalized
+                    return 'utf-8-sig'
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return 'unicode_escape'
+    return 'utf-8-sig'
+
+
+def read_table(path):
+    """
+    Parse an Excel or CSV file, depending on its extension.
+
+    Args:
+        path (str): path to the .xlsx, .xls or .csv file
+
+    Return:
+        df (pd.DataFrame): parsed table
+    """
+    if os.path.splitext(path)[1].lower() == '.csv':
+        return pd.read_csv(path, encoding=detect_encoding(path))
+    return pd.read_excel(path)
+
+
+def cache_path(path, schema, cache_dir=None):
+    """
+    Return the location of the cached table of a source file.
+
+    Args:
+        path (str): path to the source file
+        schema (dict): schema the table is coerced with
+        cache_dir (str): cache directory, defaults to CACHE_DIR
+
+    Return:
+        path (str): path to the cache file
+    """
+    path = os.path.abspath(path)
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    key = hashlib.sha256(repr((path, sorted((k, np.dtype(v).str) for k, v in schema.items()))).encode())
+    return os.path.join(cache_dir, key.hexdigest()[:32] + '.npz')
+
+
+def write_file(path, content):
+    """Atomically write bytes to a file, so concurrent readers never see a partial file."""
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def pack_table(df):
+    """
+    Convert a table to plain numpy arrays which can be saved without pickle.
+    Text columns are stored as unicode arrays with a mask of missing values.
+
+    Args:
+        df (pd.DataFrame): table with string column names
+
+    Return:
+        arrays (dict): arrays of the table, None if a column holds values other than text and missing values
+    """
+    columns = list(df.columns)
+    if not all(isinstance(column, str) for column in columns):
+        return None
+    arrays = {'columns': np.array(columns, dtype=str)}
+    for k, column in enumerate(columns):
+        values = df[column].to_numpy()
+        if values.dtype.kind == 'O':
+            missing = pd.isna(values)
+            if not all(isinstance(value, str) for value in values[~missing]):
+                return None
+            arrays[f'missing{k}'] = missing
+            values = np.where(missing, '', values).astype(str)
+        arrays[f'column{k}'] = values
+    return arrays
+
+
+def unpack_table(arrays):
+    """
+    Rebuild a table converted by pack_table.
+
+    Args:
+        arrays (mapping): arrays as returned by pack_table
+
+    Return:
+        df (pd.DataFrame): table
+    """
+    data = {}
+    for k, column in enumerate(arrays['columns']):
+        values = arrays[f'column{k}']
+        if f'missing{k}' in arrays:
+            values = np.where(arrays[f'missing{k}'], np.nan, values.astype(object))
+        data[str(column)] = values
+    return pd.DataFrame(data)
+
+
+def load_table(path, schema=None, cache_dir=None, use_cache=True):
+    """
+    Load a pipe inventory or pipe settings table with dtype coercion and a transparent on-disk cache.
+
+    The parsed table is stored column by column in a numpy .npz file, which is loaded without pickle,
+    so a planted cache file cannot execute code. Entries are keyed by file path, modification time and
+    content hash. An unchanged file is loaded from the cache without parsing it again; a touched file with
+    unchanged content is only hashed.
+
+    Args:
+        path (str): path to the .xlsx, .xls or .csv file
+        schema (dict): mapping of column name to numpy dtype, defaults to PIPE_SCHEMA
+        cache_dir (str): cache directory, defaults to CACHE_DIR
+        use_cache (bool): set to False to always parse the file
+
+    Return:
+        df (pd.DataFrame): loaded table
+    """
+    if schema is None:
+        schema = PIPE_SCHEMA
+    if not use_cache:
+        return coerce_schema(read_table(path), schema)
+
+    stat = os.stat(path)
+    location = cache_path(path, schema, cache_dir)
+    entry = None
+    try:
+        with np.load(location, allow_pickle=False) as data:
+            entry = json.loads(str(data['entry']))
+            if (entry['mtime'], entry['size']) == (stat.st_mtime_ns, stat.st_size):
+                return unpack_table(data)
+            df = unpack_table(data)
+    except Exception:
+        # a missing, corrupt or incompatible cache entry is a cache miss
+        entry = None
+
+    content_hash = file_hash(path)
+    if entry is None or entry.get('hash') != content_hash:
+        df = coerce_schema(read_table(path), schema)
+    arrays = pack_table(df)
+    if arrays is None:
+        logger.info(f"Table {path} has columns of mixed types and is not cached.")
+        return df
+    entry = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'hash': content_hash}
+    try:
+        buffer = io.BytesIO()
+        np.savez(buffer, entry=json.dumps(entry), **arrays)
+        write_file(location, buffer.getvalue())
+    except Exception as error:
+        logger.info(f"Table cache could not be written in {location}: {error}")
     return df
 
 
+def insert_excel_data(path):
+    return load_table(path, PIPE_SCHEMA)
+
+
+def insert_excel_pipe_settings(path):
+    return load_table(path, PIPE_SETTINGS_SCHEMA)
+
+
 def insert_csv_data(path):
-    data = pd.read_csv(path, encoding='unicode_escape')
-    df = pd.DataFrame(data)
-    df.rename(columns=df.iloc[0]).drop(df.index[0])
-    return df
+    return load_table(path, PIPE_SCHEMA)
 
 
-def insert_excel_pipe_settings_from_cloud(path):
-    response = requests.get(path)
-    local_pipe_settings = 'pipe_settings.xlsx'
-    with open(local_pipe_settings, 'wb') as file:
-        file.write(response.content)
-    data = pd.read_excel(local_pipe_settings)
-    df = pd.DataFrame(data)
-    df.rename(columns=df.iloc[0]).drop(df.index[0])
-    return df
+_session = None
+_download_locks = {}
+_downloads_lock = threading.Lock()
+_settings_tables = {}
+
+
+def get_session():
+    """Return the shared HTTP session, so connections are pooled and reused between downloads."""
+    global _session
+    with _downloads_lock:
+        if _session is None:
+            _session = requests.Session()
+    return _session
+
+
+def download(url, ttl=DOWNLOAD_TTL, cache_dir=CACHE_DIR, session=None, timeout=DOWNLOAD_TIMEOUT):
+    """
+    Download a file into a content-addressed local cache.
+
+    A download younger than ttl seconds is used without contacting the server. An older one is revalidated
+    with a conditional request (ETag / If-Modified-Since) and is only downloaded again if it changed.
+    Concurrent callers in the same process share one in-flight download of a url.
+
+    Args:
+        url (str): url of the file
+        ttl (int, float): number of seconds a download is used without revalidation
+        cache_dir (str): cache directory
+        session (requests.Session): session to use, defaults to the shared pooled session
+        timeout (int, float): seconds to wait for the server before raising requests.Timeout
+
+    Return:
+        path (str): path to the cached file, named after the sha256 hash of its content
+    """
+    with _downloads_lock:
+        lock = _download_locks.setdefault(url, threading.Lock())
+    with lock:
+        meta_path = os.path.join(cache_dir, hashlib.sha256(url.encode()).hexdigest()[:32] + '.json')
+        meta = None
+        try:
+            with open(meta_path) as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            pass
+        if meta is not None and not os.path.exists(meta['path']):
+            meta = None
+        if meta is not None and time.time() - meta['fetched'] < ttl:
+            return meta['path']
+
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        response = (session or get_session()).get(url, headers=headers, timeout=timeout)
+        if meta is not None and response.status_code == 304:
+            meta['fetched'] = time.time()
+        else:
+            response.raise_for_status()
+            content_hash = hashlib.sha256(response.content).hexdigest()
+            extension = os.path.splitext(url.split('?', 1)[0])[1]
+            path = os.path.join(cache_dir, content_hash + extension)
+            if not os.path.exists(path):
+                write_file(path, response.content)
+            meta = {
+                'path': path,
+                'hash': content_hash,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'fetched': time.time(),
+            }
+        write_file(meta_path, json.dumps(meta).encode())
+        return meta['path']
+
+
+def insert_excel_pipe_settings_from_cloud(path, ttl=DOWNLOAD_TTL, cache_dir=CACHE_DIR, timeout=DOWNLOAD_TIMEOUT):
+    local_pipe_settings = download(path, ttl=ttl, cache_dir=cache_dir, timeout=timeout)
+    if local_pipe_settings not in _settings_tables:
+        _settings_tables[local_pipe_settings] = load_table(local_pipe_settings, PIPE_SETTINGS_SCHEMA, cache_dir)
+    return _settings_tables[local_pipe_settings].copy()
 
 
 def insert_csv_pipe_settings(path):
-    data = pd.read_csv(path, encoding='unicode_escape')
-    df = pd.DataFrame(data)
-    df.rename(columns=df.iloc[0]).drop(df.index[0])
+    return load_table(path, PIPE_SETTINGS_SCHEMA)
+
+
+def calc_section(h, d):
+    """
+    Calculate the wetted area and hydraulic radius of circular pipes, vectorized version of
+    calculations.calc_f and calculations.calc_rh.
+
+    Args:
+        h (np.ndarray): pipe filling height [m]
+        d (np.ndarray): pipe diameter [m]
+
+    Return:
+        f, rh (np.ndarray, np.ndarray): cross-sectional area of the wetted part [m2] and hydraulic radius [m]
+    """
+    radius = d / 2
+    theta = 2 * np.arccos(np.clip(1 - h / radius, -1, 1))
+    f = radius ** 2 * (theta - np.sin(theta)) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rh = np.where(theta > 0, f / (radius * theta), 0.0)
+    return f, rh
+
+
+def calc_velocities(h, d, i):
+    """
+    Calculate the sewage flow velocity in circular pipes, vectorized version of calculations.calc_velocity.
+
+    Args:
+        h (np.ndarray): pipe filling height [m]
+        d (np.ndarray): pipe diameter [m]
+        i (np.ndarray): fall in the bottom of the sewer [‰]
+
+    Return:
+        v (np.ndarray): sewage flow velocity in the sewer [m/s]
+    """
+    _, rh = calc_section(h, d)
+    return 1 / 0.013 * rh ** (2 / 3) * np.sqrt(i / 1000)
+
+
+def calc_flows(h, d, i):
+    """
+    Calculate sewage flow in circular pipes, vectorized version of calculations.calc_flow.
+
+    Args:
+        h (np.ndarray): pipe filling height [m]
+        d (np.ndarray): pipe diameter [m]
+        i (np.ndarray): fall in the bottom of the sewer [‰]
+
+    Return:
+        q (np.ndarray): sewage flow in the channel [dm3/s]
+    """
+    f, _ = calc_section(h, d)
+    return f * 1000 * calc_velocities(h, d, i)
+
+
+# filling height step of calculations.calc_h [m] and the relative filling of the largest flow in a circular pipe
+H_STEP = 0.0001
+PEAK_FILLING = 0.938
+
+
+def calc_pipe_h(q, d, i):
+    """
+    Calculate the pipe filling height of many pipes at once, or NaN if it cannot be calculated: missing or
+    non-positive values, or a flow exceeding the capacity of a full pipe.
+
+    The result is the same as calculations.calc_h, which searches the first H_STEP multiple carrying
+    the flow. Instead of stepping through every height, all pipes are bisected together over the number of
+    steps, which takes about 20 vectorized iterations. The flow rises with the filling up to PEAK_FILLING,
+    so the first crossing lies below it.
+
+    Args:
+        q (np.ndarray): flow in the channel [dm3/s]
+        d (np.ndarray): pipe diameter [m]
+        i (np.ndarray): fall in the bottom of the sewer [‰]
+
+    Return:
+        h (np.ndarray): pipe filling height [m]
+    """
+    q, d, i = np.broadcast_arrays(*(np.asarray(a, dtype=np.float64) for a in (q, d, i)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        valid = (q >= 0) & (d > 0) & (i > 0)
+        valid &= q <= calc_flows(d, d, i)
+    q, d, i = (np.where(valid, a, 1.0) for a in (q, d, i))
+    # calc_h stops at the first step with flow >= q and returns the height one step above it
+    low = np.zeros(q.shape, dtype=np.int64)
+    high = np.ceil(d * PEAK_FILLING / H_STEP).astype(np.int64)
+    while (low < high).any():
+        middle = (low + high) // 2
+        enough = calc_flows(middle * H_STEP, d, i) >= q
+        high = np.where(enough, middle, high)
+        low = np.where(enough, low, middle + 1)
+    h = np.where(q > 0, (low + 1) * H_STEP, 0.0)
+    return np.where(valid, h, np.nan)
+
+
+def per_diameter(func, diameters):
+    """
+    Evaluate a function of the diameter once for each distinct diameter.
+
+    Args:
+        func (callable): function of the pipe diameter
+        diameters (pd.Series): pipe diameters [m]
+
+    Return:
+        values (dict): value for each distinct diameter, NaN where the function fails,
+            e.g. for diameters missing from the max_slope table
+    """
+    values = {}
+    for d in diameters.dropna().unique():
+        try:
+            value = func(d)
+        except (TypeError, ValueError, IndexError, KeyError):
+            value = None
+        values[d] = np.nan if value is None else value
+    return values
+
+
+def validate_pipes(df):
+    """
+    Run the hydraulic calculations and validity checks of Pipe_validation.ipynb on a pipe table.
+    Values which cannot be calculated are NaN and fail their validity check.
+
+    Args:
+        df (pd.DataFrame): pipe table with PIPE_SCHEMA columns
+
+    Return:
+        df (pd.DataFrame): table with calculated values and validity flags added
+    """
+    d = df['Diameter [m]'].to_numpy(dtype=np.float64)
+    i = df['slope [‰]'].to_numpy(dtype=np.float64)
+    h = calc_pipe_h(df['Flow [l/s]'].to_numpy(dtype=np.float64), d, i)
+    df['h [m]'] = h
+    df['h max [m]'] = df['Diameter [m]'].map(per_diameter(pipe.max_h, df['Diameter [m]'])).astype(np.float64)
+    # min_slope and the velocity are undefined for an empty pipe
+    filled = h > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df['slope min [‰]'] = np.where(filled, np.where(h / d >= 0.3, 1 / d, 0.25 / calc_section(h, d)[1]), np.nan)
+    df['slope max [‰]'] = df['Diameter [m]'].map(per_diameter(pipe.max_slope, df['Diameter [m]'])).astype(
+        np.float64
+    )
+    df['v [m]'] = np.where(filled, calc_velocities(h, d, i), np.nan)
+    df['dip is valid'] = (df['pipe dip [m]'] >= 1.2).astype(int)
+    df['slope is valid'] = (
+        (df['slope max [‰]'] >= df['slope [‰]']) & (df['slope [‰]'] >= df['slope min [‰]'])
+    ).astype(int)
+    df['v is valid'] = ((5 >= df['v [m]']) & (df['v [m]'] >= 0.8)).astype(int)
+    df['h is valid'] = (df['h [m]'] <= df['h max [m]']).astype(int)
     return df
 
+
+def process_chunk(chunk):
+    return validate_pipes(coerce_schema(chunk, PIPE_SCHEMA))
+
+
+def stream_csv_data(path, output, chunksize=100000, processes=None, encoding=None):
+    """
+    Validate a pipe inventory CSV in fixed-size chunks and append the results to the output CSV.
+    Peak memory is bounded by the chunk size times the number of chunks in flight.
+
+    Args:
+        path (str): path to the input CSV file
+        output (str): path to the output CSV file, overwritten if it exists
+        chunksize (int): number of rows per chunk
+        processes (int): number of worker processes, None or 1 processes chunks in the calling process
+        encoding (str): encoding of the input CSV file, detected from its first ENCODING_PREFIX bytes by default
+
+    Return:
+        rows (int): number of rows written
+    """
+    if encoding is None:
+        encoding = detect_encoding(path, ENCODING_PREFIX)
+    chunks = pd.read_csv(path, encoding=encoding, chunksize=chunksize)
+    rows = 0
+    header = True
+
+    def write(df):
+        nonlocal rows, header
+        df.to_csv(output, mode='w' if header else 'a', header=header, index=False)
+        rows += len(df)
+        header = False
+
+    if processes is None or processes <= 1:
+        for chunk in chunks:
+            write(process_chunk(chunk))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(process_chunk, chunk))
+                if len(pending) >= 2 * processes:
+                    write(pending.popleft().result())
+            while pending:
+                write(pending.popleft().result())
+    if header:
+        write(process_chunk(pd.read_csv(path, encoding=encoding, nrows=0)))
+    return rows
@@ -483,7 +483,7 @@ def max_slope(d, v=5):
 
 
 def max_h(d):
-    if 0.2 <= d <= 0.3:
+    if 0 < d <= 0.3:
         return 0.6 * d
     elif 0.3 < d <= 0.5:
         return 0.7 * d
@@ -0,0 +1,293 @@
+import os
+import hashlib
+import logging
+import numpy as np
+
+from rainwater_drainage_calculations.calculations import max_h, min_slope, max_slope
+
+logger = logging.getLogger(__name__)
+
+DIAMETERS = (0.2, 0.25, 0.3, 0.4, 0.5, 0.6, 0.8, 1.0, 1.5, 2.0)
+V_MIN = 0
+V_MAX = 5
+# largest difference between evaluate and the scikit-fuzzy model on the 1 - 100 scale
+TOLERANCE = 1
+SLOPE_POINTS = 101
+VELOCITY_POINTS = 51
+SURFACES_PATH = os.path.join(os.path.dirname(__file__), "fuzzy_surfaces.npz")
+
+# (slope, velocity) -> diameter evaluation, the rule set of "fuzzy.ipynb"
+RULES = (
+    ("low", "low", "reduction"),
+    ("low", "medium", "reduction"),
+    ("medium", "low", "reduction"),
+    ("high", "low", "reduction"),
+    ("medium", "medium", "optimal"),
+    ("high", "medium", "increase"),
+    ("low", "high", "increase"),
+    ("medium", "high", "increase"),
+    ("high", "high", "increase"),
+)
+
+# Membership functions of "fuzzy.ipynb". Every parameter (a, b, c) stands for a * low + b * high + c,
+# where low and high bound the variable: i_min and i_max for the slope, V_MIN and V_MAX for the velocity.
+MEMBERSHIPS = {
+    "slope": {
+        "low": ("zmf", ((1, 0, 0), (0, 0.5, 0))),
+        "medium": ("pimf", ((1, 0, 0), (0, 0.5, 0), (0, 0.5, 0), (0, 1, 1))),
+        "high": ("smf", ((0, 0.5, 0), (0, 1, 1))),
+    },
+    "velocity": {
+        "low": ("zmf", ((1, 0, 0), (0, 0.5, 0))),
+        "medium": ("pimf", ((1, 0, 0), (0, 0.5, 0), (0, 0.5, 0), (0, 1, 0))),
+        "high": ("smf", ((0, 0.5, 0), (0, 1, 0))),
+    },
+    "diameter": {
+        "reduction": ("zmf", ((0, 0, 1), (0, 0, 50))),
+        "optimal": ("pimf", ((0, 0, 1), (0, 0, 50), (0, 0, 50), (0, 0, 100))),
+        "increase": ("smf", ((0, 0, 50), (0, 0, 100))),
+    },
+}
+
+# (start, stop, step) of the universes, relative to the bounds of the variable as in MEMBERSHIPS
+UNIVERSES = {
+    "slope": ((1, 0, 0), (0, 1, 1), 1),
+    "velocity": ((1, 0, 0), (0, 1, 0.1), 0.1),
+    "diameter": ((0, 0, 1), (0, 0, 101), 1),
+}
+
+
+def resolve(parameters, low, high):
+    """Evaluate (a, b, c) parameters of MEMBERSHIPS or UNIVERSES for the given variable bounds."""
+    return [a * low + b * high + c for a, b, c in parameters]
+
+
+def universe(variable, low=0, high=0):
+    """Return the universe of a variable of the fuzzy model."""
+    start, stop, step = UNIVERSES[variable]
+    return np.arange(*resolve((start, stop), low, high), step)
+
+
+def zmf(x, a, b):
+    """Z-shaped membership function, the same as skfuzzy.zmf."""
+    t = np.clip((np.asarray(x, dtype=np.float64) - a) / (b - a), 0, 1)
+    return np.where(t <= 0.5, 1 - 2 * t ** 2, 2 * (1 - t) ** 2)
+
+
+def smf(x, a, b):
+    """S-shaped membership function, the same as skfuzzy.smf."""
+    return 1 - zmf(x, a, b)
+
+
+def pimf(x, a, b, c, d):
+    """Pi-shaped membership function, the same as skfuzzy.pimf."""
+    x = np.asarray(x, dtype=np.float64)
+    return np.where(x <= b, smf(x, a, b), zmf(x, c, d))
+
+
+def rules_hash():
+    """
+    Fingerprint of everything the decision surfaces depend on, used to detect an outdated cache.
+    Besides the rules and membership functions it covers the slope bounds of every diameter,
+    so changes to min_slope, max_slope and max_h in calculations also rebuild the surfaces.
+
+    Return:
+        hash (str): sha256 hex digest of the fuzzy model and the grid definition
+    """
+    definition = (
+        RULES,
+        sorted((variable, sorted(terms.items())) for variable, terms in MEMBERSHIPS.items()),
+        sorted(UNIVERSES.items()),
+        DIAMETERS,
+        [tuple(float(i) for i in slope_range(d)) for d in DIAMETERS],
+        V_MIN,
+        V_MAX,
+        SLOPE_POINTS,
+        VELOCITY_POINTS,
+    )
+    return hashlib.sha256(repr(definition).encode()).hexdigest()
+
+
+def slope_range(d):
+    """
+    Slope range of the fuzzy model of a given pipe diameter.
+
+    Args:
+        d (int, float): pipe diameter [m]
+
+    Return:
+        i_min, i_max (float, float): the minimum and maximum slope of the channel [‰]
+    """
+    return min_slope(max_h(d), d), max_slope(d)
+
+
+def build_control_system(d):
+    """
+    Build the scikit-fuzzy control system evaluating the diameter of a pipe from its slope and velocity.
+
+    Args:
+        d (int, float): pipe diameter [m]
+
+    Return:
+        simulation (skfuzzy.control.ControlSystemSimulation): simulation of the control system
+    """
+    try:
+        import skfuzzy as fuzz
+        from skfuzzy import control as ctrl
+    except ImportError as error:
+        raise ImportError(
+            "The fuzzy model and rebuilding its decision surfaces require scikit-fuzzy, "
+            "install it with: pip install rainwater_drainage_calculations[fuzzy]"
+        ) from error
+
+    bounds = {"slope": slope_range(d), "velocity": (V_MIN, V_MAX), "diameter": (0, 0)}
+    variables = {
+        "slope": ctrl.Antecedent(universe("slope", *bounds["slope"]), "slope"),
+        "velocity": ctrl.Antecedent(universe("velocity", *bounds["velocity"]), "velocity"),
+        "diameter": ctrl.Consequent(universe("diameter"), "diameter"),
+    }
+    for name, variable in variables.items():
+        for term, (function, parameters) in MEMBERSHIPS[name].items():
+            variable[term] = getattr(fuzz, function)(variable.universe, *resolve(parameters, *bounds[name]))
+    slope, velocity, diameter = variables["slope"], variables["velocity"], variables["diameter"]
+
+    rules = [ctrl.Rule(slope[s] & velocity[v], diameter[out]) for s, v, out in RULES]
+    return ctrl.ControlSystemSimulation(ctrl.ControlSystem(rules))
+
+
+def build_surfaces():
+    """
+    Precompute the defuzzified diameter evaluation of every standard diameter over a (slope, velocity) grid.
+    Requires scikit-fuzzy.
+
+    Return:
+        surfaces (dict): 'slopes' (n_diameters, SLOPE_POINTS), 'velocities' (VELOCITY_POINTS,)
+            and 'values' (n_diameters, SLOPE_POINTS, VELOCITY_POINTS) arrays
+    """
+    velocities = np.linspace(V_MIN, V_MAX, VELOCITY_POINTS)
+    slopes = np.empty((len(DIAMETERS), SLOPE_POINTS))
+    values = np.empty((len(DIAMETERS), SLOPE_POINTS, VELOCITY_POINTS))
+    for n, d in enumerate(DIAMETERS):
+        slopes[n] = np.linspace(*slope_range(d), SLOPE_POINTS)
+        s, v = np.meshgrid(slopes[n], velocities, indexing="ij")
+        simulation = build_control_system(d)
+        simulation.input["slope"] = s.ravel()
+        simulation.input["velocity"] = v.ravel()
+        simulation.compute()
+        values[n] = np.asarray(simulation.output["diameter"]).reshape(s.shape)
+    return {"slopes": slopes, "velocities": velocities, "values": values}
+
+
+def load_surfaces(path=SURFACES_PATH):
+    """
+    Load the precomputed decision surfaces, rebuilding and saving them when the rule set has changed.
+
+    Args:
+        path (str): path to the .npz file with the surfaces
+
+    Return:
+        surfaces (dict): surfaces as returned by build_surfaces
+    """
+    current = rules_hash()
+    try:
+        with np.load(path) as data:
+            if str(data["rules_hash"]) == current:
+                return {key: data[key] for key in ("slopes", "velocities", "values")}
+    except (OSError, KeyError, ValueError):
+        pass
+    logger.info(f"Rebuilding fuzzy decision surfaces in {path}.")
+    surfaces = build_surfaces()
+    try:
+        np.savez_compressed(path, rules_hash=current, **surfaces)
+    except OSError:
+        logger.info(f"Fuzzy decision surfaces could not be saved in {path}.")
+    return surfaces
+
+
+_surfaces = None
+
+
+def get_surfaces():
+    """Return the decision surfaces, loading them once per process."""
+    global _surfaces
+    if _surfaces is None:
+        _surfaces = load_surfaces()
+    return _surfaces
+
+
+def interpolate(xs, ys, z, x, y):
+    """
+    Bilinear interpolation on a regular grid. Points outside the grid are clipped to its bounds,
+    the same way scikit-fuzzy clips inputs to the universe.
+
+    Args:
+        xs (np.ndarray): increasing grid coordinates along the first axis of z
+        ys (np.ndarray): increasing grid coordinates along the second axis of z
+        z (np.ndarray): grid values
+        x (np.ndarray): first coordinates of the points
+        y (np.ndarray): second coordinates of the points
+
+    Return:
+        values (np.ndarray): interpolated values
+    """
+    x = np.clip(x, xs[0], xs[-1])
+    y = np.clip(y, ys[0], ys[-1])
+    i = np.clip(np.searchsorted(xs, x) - 1, 0, len(xs) - 2)
+    j = np.clip(np.searchsorted(ys, y) - 1, 0, len(ys) - 2)
+    tx = (x - xs[i]) / (xs[i + 1] - xs[i])
+    ty = (y - ys[j]) / (ys[j + 1] - ys[j])
+    return (
+        z[i, j] * (1 - tx) * (1 - ty)
+        + z[i + 1, j] * tx * (1 - ty)
+        + z[i, j + 1] * (1 - tx) * ty
+        + z[i + 1, j + 1] * tx * ty
+    )
+
+
+def evaluate(s, v, d):
+    """
+    Evaluate the diameter of pipes with the fuzzy logic model, from the precomputed decision surfaces.
+    Values below 50 suggest reducing the diameter and values above 50 suggest increasing it.
+    The interpolated values differ from the scikit-fuzzy model by less than TOLERANCE.
+
+    Args:
+        s (float, np.ndarray): slope of the channel [‰]
+        v (float, np.ndarray): sewage flow velocity in the sewer [m/s]
+        d (float, np.ndarray): pipe diameter [m], one of DIAMETERS
+
+    Return:
+        evaluation (np.ndarray): diameter evaluation in range 1 - 100, NaN for non-standard diameters
+    """
+    s, v, d = np.broadcast_arrays(*(np.asarray(a, dtype=np.float64) for a in (s, v, d)))
+    surfaces = get_surfaces()
+    result = np.full(s.shape, np.nan)
+    for n, diameter in enumerate(DIAMETERS):
+        mask = np.isclose(d, diameter)
+        if mask.any():
+            result[mask] = interpolate(
+                surfaces["slopes"][n], surfaces["velocities"], surfaces["values"][n], s[mask], v[mask]
+            )
+    if np.isnan(result).any():
+        logger.info(f"Diameter must be one of {DIAMETERS}.")
+    return result
+
+
+def membership(evaluation):
+    """
+    Return the diameter term with the highest membership for each evaluation.
+
+    Args:
+        evaluation (float, np.ndarray): diameter evaluation as returned by evaluate
+
+    Return:
+        membership (np.ndarray): 'reduction', 'optimal' or 'increase'
+    """
+    x = np.asarray(evaluation, dtype=np.float64)
+    points = universe("diameter")
+    functions = {"zmf": zmf, "smf": smf, "pimf": pimf}
+    terms = list(MEMBERSHIPS["diameter"])
+    memberships = np.stack([
+        np.interp(x, points, functions[function](points, *resolve(parameters, 0, 0)))
+        for function, parameters in MEMBERSHIPS["diameter"].values()
+    ])
+    return np.array(terms)[memberships.argmax(axis=0)]
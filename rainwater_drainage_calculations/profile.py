@@ -0,0 +1,274 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from rainwater_drainage_calculations.calculations import max_h, min_slope, max_slope
+
+START = "Start node"
+END = "End node"
+GROUND = "Land elevation  [m]"
+BOTTOM = "Channel bottom [m]"
+DIAMETER = "Diameter [m]"
+LENGTH = "Length [m]"
+SLOPE = "slope [‰]"
+DIP = "pipe dip [m]"
+
+logger = logging.getLogger(__name__)
+
+
+def node_codes(df):
+    """
+    Number the nodes of a pipe table.
+
+    Args:
+        df (pd.DataFrame): pipe table with 'Start node' and 'End node' columns
+
+    Return:
+        start, end, n (np.ndarray, np.ndarray, int): node number of the start and end of each pipe,
+            and the number of nodes
+    """
+    codes, uniques = pd.factorize(pd.concat([df[START], df[END]], ignore_index=True))
+    return codes[: len(df)], codes[len(df):], len(uniques)
+
+
+def routed(df):
+    """
+    Pipes taking part in the network. Rows whose start node equals their end node only mark
+    the outlet of the network, like the last row of pipes_before_validation.xlsx.
+
+    Args:
+        df (pd.DataFrame): pipe table
+
+    Return:
+        mask (np.ndarray): True for pipes connecting two different nodes
+    """
+    return (df[START] != df[END]).to_numpy()
+
+
+def pipe_levels(df):
+    """
+    Calculate the position of every pipe in the network, counted in pipes from the farthest upstream start.
+    Pipes on the same level do not depend on each other, so they can be processed in one vectorized pass.
+
+    Args:
+        df (pd.DataFrame): pipe table with 'Start node' and 'End node' columns
+
+    Return:
+        levels (np.ndarray): level of each pipe, 0 for pipes starting at the head of a run
+    """
+    start, end, n = node_codes(df)
+    mask = routed(df)
+    levels = np.zeros(len(df), dtype=np.int64)
+    for _ in range(len(df) + 1):
+        node_level = np.zeros(n, dtype=np.int64)
+        np.maximum.at(node_level, end[mask], levels[mask] + 1)
+        new_levels = node_level[start]
+        if np.array_equal(new_levels, levels):
+            return levels
+        levels = new_levels
+    raise ValueError("Loop in the network detected, the pipe table must describe a tree.")
+
+
+def ground_end(df):
+    """
+    Land elevation at the end node of every pipe, taken from the pipes starting at that node.
+
+    Args:
+        df (pd.DataFrame): pipe table
+
+    Return:
+        ground (np.ndarray): land elevation at the end of each pipe [m], NaN if unknown
+    """
+    ground = df.groupby(START)[GROUND].first()
+    return df[END].map(ground).to_numpy(dtype=np.float64)
+
+
+def receiver_inverts(df, outlets=None):
+    """
+    Invert of the sewer or receiver each node drains into, where it is fixed. It is taken from outlets,
+    or from the rows marking the outlet of the network (start node equal to end node).
+
+    Args:
+        df (pd.DataFrame): pipe table
+        outlets (dict): invert elevation [m] of the receiver at outlet nodes, by node name
+
+    Return:
+        inverts (np.ndarray): receiver invert at each node numbered as in node_codes [m], NaN if not fixed
+    """
+    start, _, n = node_codes(df)
+    inverts = np.full(n, np.nan)
+    marks = ~routed(df)
+    inverts[start[marks]] = df[BOTTOM].to_numpy(dtype=np.float64)[marks]
+    if outlets:
+        codes = pd.Series(np.concatenate([start, node_codes(df)[1]]), index=pd.concat([df[START], df[END]]))
+        codes = codes[~codes.index.duplicated()]
+        for node, invert in outlets.items():
+            if node in codes.index:
+                inverts[codes[node]] = invert
+    return inverts
+
+
+def calc_profile(df, min_dip=1.2, max_drop=0.5, settings=None, v=5, outlets=None):
+    """
+    Calculate invert elevations, cover depth and drops along pipe runs.
+
+    The land elevation and channel bottom of a row are taken at the start node of the pipe,
+    as in pipes_before_validation.xlsx. The invert at the end node follows from the length and slope.
+    A pipe is flagged as backfall when it starts above the lowest inflowing pipe or ends below
+    the receiver invert, see receiver_inverts. The cover of a pipe whose end node has no row of its own,
+    so its land elevation is unknown, cannot be checked and is marked invalid.
+
+    Args:
+        df (pd.DataFrame): pipe table with 'Start node', 'End node', 'Land elevation  [m]',
+            'Channel bottom [m]', 'Diameter [m]', 'Length [m]' and 'slope [‰]' columns
+        min_dip (int, float): minimum depth of the channel bottom below the land [m]
+        max_drop (int, float): maximum height of an inflow above the outflow bottom without a drop structure [m]
+        settings (pd.DataFrame): pipe settings, see slope_limits
+        v (int): max sewage flow velocity in the sewer used without settings [m/s]
+        outlets (dict): invert elevation [m] of the receiver at outlet nodes, by node name
+
+    Return:
+        df (pd.DataFrame): copy of the table with profile columns and validity flags added
+    """
+    df = df.copy()
+    start, end, n = node_codes(df)
+    mask = routed(df)
+    diameter = df[DIAMETER].to_numpy(dtype=np.float64)
+    length = df[LENGTH].to_numpy(dtype=np.float64)
+    slope = df[SLOPE].to_numpy(dtype=np.float64)
+    invert_start = df[BOTTOM].to_numpy(dtype=np.float64)
+    invert_end = invert_start - length * slope / 1000
+    receiver = receiver_inverts(df, outlets)
+    i_min, i_max = slope_limits(df[DIAMETER], settings, v)
+    ground_out = ground_end(df)
+    unknown = mask & np.isnan(ground_out)
+    if unknown.any():
+        pipes = [f"{a}-{b}" for a, b in zip(df[START][unknown], df[END][unknown])]
+        logger.info(f"No land elevation at the end of pipes {pipes}, their cover is marked invalid.")
+
+    inflow_max = np.full(n, -np.inf)
+    inflow_min = np.full(n, np.inf)
+    np.maximum.at(inflow_max, end[mask], invert_end[mask])
+    np.minimum.at(inflow_min, end[mask], invert_end[mask])
+    with np.errstate(invalid="ignore"):
+        drop = np.where(mask & np.isfinite(inflow_max[start]), inflow_max[start] - invert_start, 0)
+        backfall = mask & (
+            (np.isfinite(inflow_min[start]) & (inflow_min[start] < invert_start))
+            | (invert_end < receiver[end] - 0.001)
+        )
+
+    df["Invert start [m]"] = invert_start
+    df["Invert end [m]"] = invert_end
+    df["Land elevation end [m]"] = ground_out
+    df["Cover start [m]"] = df[GROUND] - invert_start - diameter
+    df["Cover end [m]"] = df["Land elevation end [m]"] - invert_end - diameter
+    df["Drop [m]"] = drop
+    df["drop structure"] = (drop > max_drop).astype(int)
+    df["backfall"] = backfall.astype(int)
+    # tolerance of 1 mm, so re-graded pipes laid exactly at min_dip are valid, unknown land elevations are invalid
+    df["cover is valid"] = (
+        (df[GROUND] - invert_start >= min_dip - 0.001) & (~mask | (ground_out - invert_end >= min_dip - 0.001))
+    ).astype(int)
+    # pipes without known limits are invalid
+    df["slope is valid"] = (~mask | ((slope >= i_min - 1e-9) & (slope <= i_max + 1e-9))).astype(int)
+    return df
+
+
+def slope_limits(d, settings=None, v=5):
+    """
+    Minimum and maximum slope of pipes. Diameters are matched to the settings to the millimetre.
+
+    Args:
+        d (np.ndarray): pipe diameters [m]
+        settings (pd.DataFrame): pipe settings with 'diameter', 'min_slope' and 'max_slope' columns,
+            as returned by insert_excel_pipe_settings. Defaults to the limits of full filling from calculations.
+        v (int): max sewage flow velocity in the sewer used without settings [m/s]
+
+    Return:
+        i_min, i_max (np.ndarray, np.ndarray): the minimum and maximum slope of the channel [‰],
+            NaN where the diameter is missing from the settings or from the max_slope table
+    """
+    d = pd.Series(np.asarray(d, dtype=np.float64)).round(3)
+    if settings is not None:
+        limits = settings.assign(diameter=settings["diameter"].round(3)).drop_duplicates("diameter")
+        limits = limits.set_index("diameter")
+        i_min = d.map(limits["min_slope"]).to_numpy(dtype=np.float64)
+        i_max = d.map(limits["max_slope"]).to_numpy(dtype=np.float64)
+    else:
+        i_min, i_max = {}, {}
+        for x in d.dropna().unique():
+            i_min[x] = min_slope(max_h(x), x)
+            try:
+                i_max[x] = max_slope(x, v)
+            except (TypeError, ValueError, IndexError, KeyError):
+                i_max[x] = np.nan
+        i_min = d.map(i_min).to_numpy(dtype=np.float64)
+        i_max = d.map(i_max).to_numpy(dtype=np.float64)
+    missing = d[d.notna() & (np.isnan(i_min) | np.isnan(i_max))].unique()
+    if len(missing):
+        logger.info(f"No slope limits for diameters {sorted(missing)}, their slopes are marked invalid.")
+    return i_min, i_max
+
+
+def regrade(df, settings=None, min_dip=1.2, max_drop=0.5, v=5, outlets=None):
+    """
+    Re-grade pipe runs so that every pipe has a slope between its min_slope and max_slope,
+    the channel bottom is at least min_dip below the land at both ends and no pipe flows into a higher one
+    or ends below the receiver it drains into.
+
+    First, going upstream from the receivers, every node gets the lowest invert which still lets the pipes
+    below it reach their receiver at min_slope. Then, starting from the head of each run, a pipe starts
+    at min_dip below the land or at the lowest inflowing invert, whichever is lower, but not below that
+    invert. Its slope is the current slope clipped to the limits, steepened up to max_slope when needed to
+    keep the cover at the end node. If that is not enough, the pipe is lowered. Where the receiver is too
+    high for the cover, the receiver wins and the pipe is flagged in 'cover is valid', as are pipes
+    ending at a node without land elevation. Pipes without slope limits keep their slope and are flagged
+    in 'slope is valid'.
+
+    Args:
+        df (pd.DataFrame): pipe table, see calc_profile
+        settings (pd.DataFrame): pipe settings, see slope_limits
+        min_dip (int, float): minimum depth of the channel bottom below the land [m]
+        max_drop (int, float): maximum height of an inflow above the outflow bottom without a drop structure [m]
+        v (int): max sewage flow velocity in the sewer used without settings [m/s]
+        outlets (dict): invert elevation [m] of the receiver at outlet nodes, by node name
+
+    Return:
+        df (pd.DataFrame): re-graded copy of the table with profile columns as in calc_profile
+    """
+    df = df.copy()
+    start, end, n = node_codes(df)
+    mask = routed(df)
+    levels = pipe_levels(df)
+    i_min, i_max = slope_limits(df[DIAMETER], settings, v)
+    length = df[LENGTH].to_numpy(dtype=np.float64)
+    ground = df[GROUND].to_numpy(dtype=np.float64)
+    ground_out = ground_end(df)
+    order = np.unique(levels[mask])
+
+    floor = np.nan_to_num(receiver_inverts(df, outlets), nan=-np.inf)
+    for level in order[::-1]:
+        idx = np.flatnonzero(mask & (levels == level))
+        np.maximum.at(floor, start[idx], floor[end[idx]] + length[idx] * np.nan_to_num(i_min[idx]) / 1000)
+
+    slope = np.fmin(np.fmax(df[SLOPE].to_numpy(dtype=np.float64), i_min), i_max)
+    invert_start = df[BOTTOM].to_numpy(dtype=np.float64).copy()
+    inflow_min = np.full(n, np.inf)
+    for level in order:
+        idx = np.flatnonzero(mask & (levels == level))
+        lowest = floor[start[idx]]
+        top = np.fmax(np.fmin(ground[idx] - min_dip, inflow_min[start[idx]]), lowest)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            required = (top - (ground_out[idx] - min_dip)) / length[idx] * 1000
+            reach = (top - floor[end[idx]]) / length[idx] * 1000
+        steepest = np.fmin(np.where(np.isnan(i_max[idx]), slope[idx], i_max[idx]), reach)
+        s = np.fmin(np.fmax(slope[idx], required), steepest)
+        top = np.fmax(np.fmin(top, ground_out[idx] - min_dip + length[idx] * s / 1000), lowest)
+        slope[idx] = s
+        invert_start[idx] = top
+        np.minimum.at(inflow_min, end[idx], top - length[idx] * s / 1000)
+
+    df[SLOPE] = np.where(mask, slope, df[SLOPE])
+    df[BOTTOM] = np.where(mask, invert_start, df[BOTTOM])
+    df[DIP] = df[GROUND] - df[BOTTOM]
+    return calc_profile(df, min_dip, max_drop, settings, v, outlets)
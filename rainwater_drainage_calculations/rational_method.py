@@ -0,0 +1,501 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from rainwater_drainage_calculations.calculations import calc_flow, max_h
+
+logger = logging.getLogger(__name__)
+
+# runoff from 1 mm/h of rain falling on 1 ha expressed in [dm3/s]
+MM_H_HA_TO_L_S = 10000 / 3600
+
+SI_FLOW_UNITS = ("CMS", "LPS", "MLD")
+US_FLOW_UNITS = ("CFS", "GPM", "MGD")
+FT_TO_M = 0.3048
+ACRE_TO_HA = 0.40468564224
+
+LINK_SECTIONS = ("CONDUITS", "PUMPS", "ORIFICES", "WEIRS", "OUTLETS")
+
+
+def read_inp_section(path, section):
+    """
+    Read a single section of a SWMM INP file as raw text tokens, without running SWMM.
+
+    Args:
+        path (str): path to the SWMM INP file
+        section (str): section name, with or without brackets, e.g. 'SUBCATCHMENTS'
+
+    Return:
+        rows (list): list of token lists, one for each data line of the section
+    """
+    header = "[" + section.strip("[]").upper() + "]"
+    rows = []
+    in_section = False
+    with open(path, encoding="utf-8", errors="replace") as file:
+        for line in file:
+            line = line.split(";", 1)[0].strip()
+            if line.startswith("["):
+                in_section = line.upper() == header
+                continue
+            if in_section and line:
+                rows.append(line.split())
+    return rows
+
+
+def read_option(path, name, default):
+    """
+    Read the value of an option from the [OPTIONS] section.
+
+    Args:
+        path (str): path to the SWMM INP file
+        name (str): option name, e.g. 'FLOW_UNITS'
+        default (str): value used by SWMM when the option is missing
+
+    Return:
+        value (str): upper case value of the option
+    """
+    for row in read_inp_section(path, "OPTIONS"):
+        if row[0].upper() == name and len(row) > 1:
+            return row[1].upper()
+    return default
+
+
+def read_flow_units(path):
+    """
+    Read FLOW_UNITS from the [OPTIONS] section. SWMM uses US customary units for lengths and areas
+    with CFS, GPM and MGD, and SI units with CMS, LPS and MLD.
+
+    Args:
+        path (str): path to the SWMM INP file
+
+    Return:
+        units (str): flow units, CFS when the option is missing as in SWMM
+    """
+    units = read_option(path, "FLOW_UNITS", "CFS")
+    if units not in SI_FLOW_UNITS + US_FLOW_UNITS:
+        raise ValueError(f"Unknown FLOW_UNITS {units}.")
+    return units
+
+
+def read_link_offsets(path):
+    """
+    Read LINK_OFFSETS from the [OPTIONS] section. With DEPTH the offsets of links are heights above
+    the node invert, with ELEVATION they are absolute elevations.
+
+    Args:
+        path (str): path to the SWMM INP file
+
+    Return:
+        offsets (str): 'DEPTH' or 'ELEVATION', DEPTH when the option is missing as in SWMM
+    """
+    offsets = read_option(path, "LINK_OFFSETS", "DEPTH")
+    if offsets not in ("DEPTH", "ELEVATION"):
+        raise ValueError(f"Unknown LINK_OFFSETS {offsets}.")
+    return offsets
+
+
+def unit_factors(path):
+    """
+    Factors converting the lengths and areas of the INP file to metres and hectares.
+
+    Args:
+        path (str): path to the SWMM INP file
+
+    Return:
+        length, area (float, float): factors for lengths [m] and areas [ha]
+    """
+    if read_flow_units(path) in US_FLOW_UNITS:
+        return FT_TO_M, ACRE_TO_HA
+    return 1.0, 1.0
+
+
+def read_subcatchments(path):
+    """
+    Read subcatchment area, imperviousness, width and slope from the [SUBCATCHMENTS] section.
+    Files in US units are converted to SI.
+
+    Args:
+        path (str): path to the SWMM INP file
+
+    Return:
+        subcatchments (pd.DataFrame): subcatchments indexed by name with columns
+            Outlet, Area [ha], Imperv [%], Width [m], Slope [%]
+    """
+    rows = read_inp_section(path, "SUBCATCHMENTS")
+    df = pd.DataFrame(
+        data=[row[:7] for row in rows],
+        columns=["Name", "Rain Gage", "Outlet", "Area [ha]", "Imperv [%]", "Width [m]", "Slope [%]"],
+    )
+    df = df.drop(columns="Rain Gage").set_index("Name")
+    for column in ["Area [ha]", "Imperv [%]", "Width [m]", "Slope [%]"]:
+        df[column] = df[column].astype(np.float64)
+    length, area = unit_factors(path)
+    df["Area [ha]"] *= area
+    df["Width [m]"] *= length
+    return df
+
+
+def calc_runoff_coefficient(imperv, c_imperv=0.9, c_perv=0.15):
+    """
+    Calculate the area weighted runoff coefficient of a subcatchment.
+
+    Args:
+        imperv (int, float, np.ndarray): percentage of impervious area [%]
+        c_imperv (float): runoff coefficient of the impervious part [-]
+        c_perv (float): runoff coefficient of the pervious part [-]
+
+    Return:
+        c (float, np.ndarray): runoff coefficient [-]
+    """
+    imperv = np.asarray(imperv, dtype=np.float64) / 100
+    return imperv * c_imperv + (1 - imperv) * c_perv
+
+
+def calc_time_of_concentration(area, width, slope, imperv, intensity, n_imperv=0.01, n_perv=0.1):
+    """
+    Calculate the overland flow time of concentration with the kinematic wave formula
+    tc = 6.99 * (n * L) ** 0.6 / (i ** 0.4 * S ** 0.3). The overland flow length L is
+    taken as area / width, the same way SWMM derives it for a subcatchment.
+
+    Subcatchment parameters and rainfall intensity are broadcast against each other,
+    so passing subcatchments as a column and scenarios as a row gives every combination at once.
+
+    Args:
+        area (float, np.ndarray): subcatchment area [ha]
+        width (float, np.ndarray): characteristic width of overland flow [m]
+        slope (float, np.ndarray): subcatchment slope [%]
+        imperv (float, np.ndarray): percentage of impervious area [%]
+        intensity (float, np.ndarray): rainfall intensity [mm/h]
+        n_imperv (float): Manning's n of the impervious part
+        n_perv (float): Manning's n of the pervious part
+
+    Return:
+        tc (float, np.ndarray): time of concentration [min]
+    """
+    imperv = np.asarray(imperv, dtype=np.float64) / 100
+    n = imperv * n_imperv + (1 - imperv) * n_perv
+    length = np.asarray(area, dtype=np.float64) * 10000 / np.asarray(width, dtype=np.float64)
+    s = np.asarray(slope, dtype=np.float64) / 100
+    with np.errstate(divide="ignore"):
+        return 6.99 * (n * length) ** 0.6 / (np.asarray(intensity, dtype=np.float64) ** 0.4 * s ** 0.3)
+
+
+def idf_scenarios(idf):
+    """
+    Normalize the rainfall intensity-duration-frequency relation of the design scenarios.
+
+    Args:
+        idf (callable, dict, pd.DataFrame): function of the rain duration [min] returning the intensity [mm/h],
+            dict of such functions keyed by scenario name, or a table of intensities [mm/h] indexed
+            by duration [min] with one column per scenario
+
+    Return:
+        scenarios (dict): function of the duration [min] returning the intensity [mm/h] for each scenario
+    """
+    if isinstance(idf, pd.DataFrame):
+        durations = idf.index.to_numpy(dtype=np.float64)
+        return {
+            name: (lambda t, values=idf[name].to_numpy(dtype=np.float64): np.interp(t, durations, values))
+            for name in idf.columns
+        }
+    if isinstance(idf, dict):
+        return idf
+    if callable(idf):
+        return {0: idf}
+    raise TypeError("idf must be a callable, a dict of callables or a DataFrame.")
+
+
+def calc_design_intensity(subcatchments, idf, min_tc=5, n_imperv=0.01, n_perv=0.1, iterations=50, tolerance=0.01):
+    """
+    Find the time of concentration of every subcatchment in every scenario and the rainfall intensity
+    of a rain lasting that long. The kinematic wave tc depends on the intensity and the intensity on
+    the duration, so both are found together by fixed point iteration over all combinations at once.
+
+    Args:
+        subcatchments (pd.DataFrame): subcatchments as returned by read_subcatchments
+        idf (callable, dict, pd.DataFrame): design scenarios, see idf_scenarios
+        min_tc (int, float): lower limit of the time of concentration [min]
+        n_imperv (float): Manning's n of the impervious part
+        n_perv (float): Manning's n of the pervious part
+        iterations (int): maximum number of iterations
+        tolerance (float): change of tc at which the iteration stops [min]
+
+    Return:
+        tc, intensity (pd.DataFrame, pd.DataFrame): time of concentration [min] and design rainfall
+            intensity [mm/h], subcatchments in rows and scenarios in columns
+    """
+    scenarios = idf_scenarios(idf)
+    columns = list(scenarios)
+    parameters = [
+        subcatchments[column].to_numpy()[:, None]
+        for column in ("Area [ha]", "Width [m]", "Slope [%]", "Imperv [%]")
+    ]
+
+    def intensity_at(duration):
+        return np.column_stack(
+            [np.asarray(scenarios[name](duration[:, j]), dtype=np.float64) for j, name in enumerate(columns)]
+        )
+
+    tc = np.full((len(subcatchments), len(columns)), float(min_tc))
+    for _ in range(iterations):
+        intensity = intensity_at(tc)
+        new_tc = np.fmax(calc_time_of_concentration(*parameters, intensity, n_imperv, n_perv), min_tc)
+        converged = np.nanmax(np.abs(new_tc - tc), initial=0) < tolerance
+        tc = new_tc
+        if converged:
+            break
+    else:
+        logger.info("Time of concentration did not converge.")
+    intensity = intensity_at(tc)
+    return (
+        pd.DataFrame(data=tc, index=subcatchments.index, columns=columns),
+        pd.DataFrame(data=intensity, index=subcatchments.index, columns=columns),
+    )
+
+
+def calc_peak_runoff(subcatchments, idf, c_imperv=0.9, c_perv=0.15, min_tc=5):
+    """
+    Estimate the peak runoff of every subcatchment for every rainfall scenario with the rational method
+    Q = C * i(tc) * A, where i(tc) is the intensity of a rain lasting the time of concentration.
+
+    Args:
+        subcatchments (pd.DataFrame): subcatchments as returned by read_subcatchments
+        idf (callable, dict, pd.DataFrame): design scenarios, see idf_scenarios
+        c_imperv (float): runoff coefficient of the impervious part [-]
+        c_perv (float): runoff coefficient of the pervious part [-]
+        min_tc (int, float): lower limit of the time of concentration [min]
+
+    Return:
+        q (pd.DataFrame): peak runoff [dm3/s], subcatchments in rows and scenarios in columns
+    """
+    _, intensity = calc_design_intensity(subcatchments, idf, min_tc)
+    c = calc_runoff_coefficient(subcatchments["Imperv [%]"].to_numpy(), c_imperv, c_perv)
+    area = subcatchments["Area [ha]"].to_numpy()
+    return intensity.mul(c * area * MM_H_HA_TO_L_S, axis=0)
+
+
+def read_links(path):
+    """
+    Read the nodes connected by every link of the INP file: conduits, pumps, orifices, weirs and outlets.
+
+    Args:
+        path (str): path to the SWMM INP file
+
+    Return:
+        links (pd.DataFrame): links indexed by name with columns From Node, To Node, Type,
+            where Type is the section name, e.g. 'WEIRS'
+    """
+    data = [
+        [row[0], row[1], row[2], section]
+        for section in LINK_SECTIONS
+        for row in read_inp_section(path, section)
+    ]
+    df = pd.DataFrame(data=data, columns=["Name", "From Node", "To Node", "Type"])
+    return df.set_index("Name")
+
+
+def read_conduits(path):
+    """
+    Read conduits with their shape, diameter and bottom slope from the INP file.
+    Offsets are read as depths or elevations depending on LINK_OFFSETS, '*' stands for the node invert.
+    Files in US units are converted to SI.
+
+    Args:
+        path (str): path to the SWMM INP file
+
+    Return:
+        conduits (pd.DataFrame): conduits indexed by name with columns
+            From Node, To Node, Shape, Length [m], Diameter [m], slope [‰].
+            Diameter is NaN for conduits which are not circular.
+    """
+    length_factor, _ = unit_factors(path)
+    elevation_offsets = read_link_offsets(path) == "ELEVATION"
+    elevations = {
+        row[0]: float(row[1])
+        for section in ("JUNCTIONS", "OUTFALLS", "STORAGE", "DIVIDERS")
+        for row in read_inp_section(path, section)
+    }
+    # Geom1 of irregular, custom and street sections is the name of a transect or curve
+    shapes = {row[0]: row[1].upper() for row in read_inp_section(path, "XSECTIONS")}
+    diameters = {
+        row[0]: float(row[2]) for row in read_inp_section(path, "XSECTIONS") if row[1].upper() == "CIRCULAR"
+    }
+
+    def invert(node, offset):
+        if offset == "*":
+            return elevations[node]
+        if elevation_offsets:
+            return float(offset)
+        return elevations[node] + float(offset)
+
+    data = []
+    for row in read_inp_section(path, "CONDUITS"):
+        name, from_node, to_node, length = row[0], row[1], row[2], float(row[3])
+        in_offset, out_offset = (row[5:7] + ["0", "0"])[:2]
+        fall = invert(from_node, in_offset) - invert(to_node, out_offset)
+        diameter = diameters.get(name, np.nan) * length_factor
+        data.append(
+            [name, from_node, to_node, shapes.get(name), length * length_factor, diameter, fall / length * 1000]
+        )
+    df = pd.DataFrame(
+        data=data,
+        columns=["Name", "From Node", "To Node", "Shape", "Length [m]", "Diameter [m]", "slope [‰]"],
+    )
+    return df.set_index("Name")
+
+
+def subcatchment_outlets(subcatchments):
+    """
+    Find the node every subcatchment finally drains to, following subcatchments which drain to other ones.
+
+    Args:
+        subcatchments (pd.DataFrame): subcatchments as returned by read_subcatchments
+
+    Return:
+        outlets (pd.Series): outlet node of each subcatchment
+    """
+    outlets = subcatchments["Outlet"]
+    for _ in range(len(subcatchments) + 1):
+        to_subcatchment = outlets.isin(subcatchments.index)
+        if not to_subcatchment.any():
+            return outlets
+        outlets = outlets.where(~to_subcatchment, outlets.map(subcatchments["Outlet"]))
+    raise ValueError("Loop in the routing of subcatchments detected.")
+
+
+def accumulate_flows(links, subcatchments, q):
+    """
+    Sum the peak runoff of all subcatchments draining to each link, directly or through upstream links.
+
+    Every subcatchment contributes its own peak, reached at its own time of concentration, and the travel
+    time in the pipes is neglected. The result is an upper bound of the rational method flow, the higher
+    the more subcatchments a link collects. How the flow divides where a node has several outgoing links
+    depends on the hydraulics, so the flow of those links and of everything downstream of them is unknown (NaN).
+
+    Nodes are visited in topological order, from the heads of the network to the outfalls.
+
+    Args:
+        links (pd.DataFrame): links with 'From Node' and 'To Node' columns, as returned by read_links
+        subcatchments (pd.DataFrame): subcatchments as returned by read_subcatchments
+        q (pd.DataFrame): peak runoff of subcatchments as returned by calc_peak_runoff
+
+    Return:
+        flow (pd.DataFrame): design flow [dm3/s], links in rows and scenarios in columns
+    """
+    codes, nodes = pd.factorize(
+        pd.concat([links["From Node"], links["To Node"], subcatchment_outlets(subcatchments)], ignore_index=True)
+    )
+    n_links = len(links)
+    from_node = codes[:n_links]
+    to_node = codes[n_links: 2 * n_links]
+    outlet = codes[2 * n_links:]
+
+    node_flow = np.zeros((len(nodes), q.shape[1]))
+    np.add.at(node_flow, outlet, q.to_numpy())
+
+    outgoing = [[] for _ in nodes]
+    for index, node in enumerate(from_node):
+        outgoing[node].append(index)
+    split = np.bincount(from_node, minlength=len(nodes)) > 1
+    indegree = np.bincount(to_node, minlength=len(nodes))
+    queue = list(np.flatnonzero(indegree == 0))
+    visited = 0
+    while queue:
+        node = queue.pop()
+        visited += 1
+        for index in outgoing[node]:
+            node_flow[to_node[index]] += np.nan if split[node] else node_flow[node]
+            indegree[to_node[index]] -= 1
+            if indegree[to_node[index]] == 0:
+                queue.append(to_node[index])
+    if visited < len(nodes):
+        raise ValueError("Loop in the network detected.")
+
+    flow = np.where(split[from_node][:, None], np.nan, node_flow[from_node])
+    return pd.DataFrame(data=flow, index=links.index, columns=q.columns)
+
+
+def calc_capacity(d, i):
+    """
+    Calculate the flow capacity of a pipe filled up to the maximum allowed filling height.
+
+    Args:
+        d (int, float): pipe diameter [m]
+        i (int, float): fall in the bottom of the sewer [‰]
+
+    Return:
+        q (int, float): flow capacity of the pipe [dm3/s], NaN if the pipe is not circular
+    """
+    if np.isnan(d):
+        return np.nan
+    if i <= 0:
+        return 0.0
+    return calc_flow(max_h(d), d, i)
+
+
+def prescreen(conduits, flow, lower=0.8, upper=1.2):
+    """
+    Compare design flows with pipe capacities and flag the cases which need a full dynamic wave simulation.
+
+    Each conduit and scenario is classified by the ratio of its design flow to its capacity as:
+        'valid'       - ratio below lower, the pipe is sufficient,
+        'borderline'  - ratio between lower and upper, run SWMM to decide,
+        'overloaded'  - ratio above upper, the pipe is likely insufficient, run SWMM to confirm,
+        'not checked' - the conduit is not circular or its design flow is unknown, run SWMM to decide.
+
+    The design flows of accumulate_flows overestimate the flow, so only 'valid' is a final verdict,
+    see needs_simulation.
+
+    Args:
+        conduits (pd.DataFrame): table with 'Diameter [m]' and 'slope [‰]' columns
+        flow (pd.DataFrame): design flow [dm3/s], conduits in rows and scenarios in columns
+        lower (float): ratio below which the pipe is considered valid
+        upper (float): ratio above which the pipe is considered overloaded
+
+    Return:
+        status (pd.DataFrame): classification, conduits in rows and scenarios in columns
+    """
+    capacity = np.array(
+        [calc_capacity(d, i) for d, i in zip(conduits["Diameter [m]"], conduits["slope [‰]"])]
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = flow.to_numpy() / capacity[:, None]
+    status = np.where(ratio < lower, "valid", np.where(ratio > upper, "overloaded", "borderline"))
+    status = np.where(np.isnan(ratio), "not checked", status)
+    return pd.DataFrame(data=status, index=flow.index, columns=flow.columns)
+
+
+def needs_simulation(status):
+    """
+    Select the conduits which have to be checked with SWMM, i.e. all which are not 'valid' in some scenario.
+
+    Args:
+        status (pd.DataFrame): classification as returned by prescreen
+
+    Return:
+        mask (pd.Series): True for conduits to simulate
+    """
+    return (status != "valid").any(axis=1)
+
+
+def prescreen_inp(path, idf, lower=0.8, upper=1.2, c_imperv=0.9, c_perv=0.15, min_tc=5):
+    """
+    Run the whole rational method pre-screening on a SWMM INP file.
+
+    Args:
+        path (str): path to the SWMM INP file
+        idf (callable, dict, pd.DataFrame): design scenarios, see idf_scenarios
+        lower (float): ratio below which the pipe is considered valid
+        upper (float): ratio above which the pipe is considered overloaded
+        c_imperv (float): runoff coefficient of the impervious part [-]
+        c_perv (float): runoff coefficient of the pervious part [-]
+        min_tc (int, float): lower limit of the time of concentration [min]
+
+    Return:
+        status (pd.DataFrame): classification, conduits in rows and scenarios in columns
+    """
+    subcatchments = read_subcatchments(path)
+    conduits = read_conduits(path)
+    q = calc_peak_runoff(subcatchments, idf, c_imperv, c_perv, min_tc)
+    flow = accumulate_flows(read_links(path), subcatchments, q)
+    return prescreen(conduits, flow.loc[conduits.index], lower, upper)
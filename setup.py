@@ -7,5 +7,7 @@ setup(
     description="Collection of calculation method for rainwater drainage",
     author="Rafał Buczyński",
     packages=["rainwater_drainage_calculations"],
+    package_data={"rainwater_drainage_calculations": ["fuzzy_surfaces.npz"]},
     install_requires=["requests", "pandas", "numpy", "matplotlib"],
+    extras_require={"fuzzy": ["scikit-fuzzy"]},
 )
\ No newline at end of file
@@ -0,0 +1,13 @@
+import pytest
+
+from rainwater_drainage_calculations import calculations
+
+
+@pytest.mark.parametrize("d, h", [(0.16, 0.096), (0.2, 0.12), (0.4, 0.28), (0.6, 0.45), (1.0, 0.8)])
+def test_max_h(d, h):
+    assert calculations.max_h(d) == pytest.approx(h)
+
+
+def test_max_h_of_non_positive_diameter():
+    assert calculations.max_h(0) is None
+    assert calculations.max_h(-0.2) is None
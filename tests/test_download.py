@@ -0,0 +1,75 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import manage_file
+
+SETTINGS = os.path.join(os.path.dirname(__file__), '..', 'pipe_settings.xlsx')
+
+
+@pytest.fixture
+def server():
+    with open(SETTINGS, 'rb') as file:
+        body = file.read()
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(0.2)
+            requests_seen.append(self.headers.get('If-None-Match'))
+            if self.path == '/stalled':
+                time.sleep(2)
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_port}', requests_seen
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_download_is_cached_and_revalidated(server, tmp_path):
+    url, requests_seen = server
+    url += '/pipe_settings.xlsx'
+    cache_dir = str(tmp_path)
+    results = []
+    callers = [
+        threading.Thread(
+            target=lambda: results.append(manage_file.insert_excel_pipe_settings_from_cloud(url, cache_dir=cache_dir))
+        )
+        for _ in range(5)
+    ]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join()
+    assert len(results) == 5
+    assert requests_seen == [None]
+
+    manage_file.insert_excel_pipe_settings_from_cloud(url, cache_dir=cache_dir)
+    assert requests_seen == [None]
+
+    df = manage_file.insert_excel_pipe_settings_from_cloud(url, ttl=0, cache_dir=cache_dir)
+    assert requests_seen == [None, '"v1"']
+    assert df['diameter'].dtype == 'float64'
+
+
+def test_stalled_server_times_out(server, tmp_path):
+    url, _ = server
+    with pytest.raises(requests.Timeout):
+        manage_file.download(url + '/stalled', cache_dir=str(tmp_path), timeout=0.5)
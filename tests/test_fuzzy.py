@@ -0,0 +1,53 @@
+import sys
+
+import numpy as np
+import pytest
+
+from rainwater_drainage_calculations import fuzzy
+
+
+def test_shipped_surfaces_are_current(monkeypatch):
+    def rebuild():
+        raise AssertionError("shipped surfaces are outdated")
+
+    monkeypatch.setattr(fuzzy, "build_surfaces", rebuild)
+    surfaces = fuzzy.load_surfaces()
+    assert surfaces["values"].shape == (len(fuzzy.DIAMETERS), fuzzy.SLOPE_POINTS, fuzzy.VELOCITY_POINTS)
+
+
+def test_hash_covers_memberships_and_slope_bounds(monkeypatch):
+    current = fuzzy.rules_hash()
+    memberships = dict(fuzzy.MEMBERSHIPS, diameter=dict(fuzzy.MEMBERSHIPS["diameter"]))
+    memberships["diameter"]["optimal"] = ("pimf", ((0, 0, 1), (0, 0, 40), (0, 0, 60), (0, 0, 100)))
+    monkeypatch.setattr(fuzzy, "MEMBERSHIPS", memberships)
+    assert fuzzy.rules_hash() != current
+    monkeypatch.undo()
+
+    monkeypatch.setattr(fuzzy, "max_slope", lambda d: 1.0)
+    assert fuzzy.rules_hash() != current
+
+
+def test_evaluate_non_standard_diameter_is_nan():
+    result = fuzzy.evaluate([50.56, 3.0], [2.15, 1.0], [0.2, 0.33])
+    assert 1 <= result[0] <= 100
+    assert np.isnan(result[1])
+
+
+def test_evaluate_matches_control_system():
+    pytest.importorskip("skfuzzy")
+    rng = np.random.default_rng(0)
+    for d in (0.2, 0.5, 1.5):
+        slopes = rng.uniform(*fuzzy.slope_range(d), 100)
+        velocities = rng.uniform(fuzzy.V_MIN, fuzzy.V_MAX, 100)
+        simulation = fuzzy.build_control_system(d)
+        simulation.input["slope"] = slopes
+        simulation.input["velocity"] = velocities
+        simulation.compute()
+        expected = np.asarray(simulation.output["diameter"])
+        np.testing.assert_allclose(fuzzy.evaluate(slopes, velocities, d), expected, atol=fuzzy.TOLERANCE)
+
+
+def test_missing_scikit_fuzzy_is_reported(monkeypatch):
+    monkeypatch.setitem(sys.modules, "skfuzzy", None)
+    with pytest.raises(ImportError, match=r"rainwater_drainage_calculations\[fuzzy\]"):
+        fuzzy.build_control_system(0.2)
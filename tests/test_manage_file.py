@@ -0,0 +1,171 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import manage_file
+from rainwater_drainage_calculations import calculations as pipe
+
+PIPES = pd.DataFrame({
+    'Start node': ['W1', 'S1'],
+    'End node': ['S1', 'S2'],
+    'Flow [l/s]': [26, 44],
+    'Diameter [m]': [0.2, 0.6],
+    'slope [‰]': [50.56, 2.214022],
+})
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    directory = tmp_path / 'cache'
+    monkeypatch.setattr(manage_file, 'CACHE_DIR', str(directory))
+    return directory
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    calls = []
+    read_table = manage_file.read_table
+
+    def counting(path):
+        calls.append(path)
+        return read_table(path)
+
+    monkeypatch.setattr(manage_file, 'read_table', counting)
+    return calls
+
+
+def test_utf8_csv_is_coerced(tmp_path):
+    path = tmp_path / 'pipes.csv'
+    PIPES.to_csv(path, index=False)
+    df = manage_file.insert_csv_data(str(path))
+    assert df['slope [‰]'].dtype == 'float64'
+    assert df['Flow [l/s]'].dtype == 'float64'
+
+
+def test_corrupt_cache_entry_is_a_miss(tmp_path):
+    path = tmp_path / 'pipes.csv'
+    PIPES.to_csv(path, index=False)
+    location = manage_file.cache_path(str(path), manage_file.PIPE_SCHEMA)
+    manage_file.write_file(location, b'old format')
+    df = manage_file.insert_csv_data(str(path))
+    assert list(df['Start node']) == ['W1', 'S1']
+    with np.load(location, allow_pickle=False) as data:
+        assert manage_file.unpack_table(data).equals(df)
+
+
+def test_cache_is_kept_out_of_the_source_folder(tmp_path, cache_dir):
+    path = tmp_path / 'inventory' / 'pipes.csv'
+    path.parent.mkdir()
+    PIPES.to_csv(path, index=False)
+    manage_file.insert_csv_data(str(path))
+    assert os.listdir(path.parent) == ['pipes.csv']
+    assert len(os.listdir(cache_dir)) == 1
+
+
+def test_repeated_load_is_served_from_cache(tmp_path, reads):
+    path = tmp_path / 'pipes.csv'
+    PIPES.to_csv(path, index=False)
+    first = manage_file.insert_csv_data(str(path))
+    second = manage_file.insert_csv_data(str(path))
+    assert len(reads) == 1
+    assert second.equals(first)
+
+
+def test_touched_file_is_matched_by_hash(tmp_path, reads):
+    path = tmp_path / 'pipes.csv'
+    PIPES.to_csv(path, index=False)
+    first = manage_file.insert_csv_data(str(path))
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert manage_file.insert_csv_data(str(path)).equals(first)
+    assert manage_file.insert_csv_data(str(path)).equals(first)
+    assert len(reads) == 1
+
+
+def test_changed_file_invalidates_cache(tmp_path, reads):
+    path = tmp_path / 'pipes.csv'
+    PIPES.to_csv(path, index=False)
+    manage_file.insert_csv_data(str(path))
+    PIPES.assign(**{'Flow [l/s]': [27, 44]}).to_csv(path, index=False)
+    df = manage_file.insert_csv_data(str(path))
+    assert len(reads) == 2
+    assert list(df['Flow [l/s]']) == [27.0, 44.0]
+
+
+def test_unwritable_cache_is_skipped(tmp_path):
+    path = tmp_path / 'pipes.csv'
+    PIPES.to_csv(path, index=False)
+    not_a_directory = tmp_path / 'file'
+    not_a_directory.write_text('')
+    df = manage_file.load_table(str(path), cache_dir=str(not_a_directory / 'cache'))
+    assert len(df) == 2
+
+
+def inventory(rows):
+    return pd.DataFrame({
+        'Lp.': range(1, rows + 1),
+        'Start node': [f'W{k}' for k in range(rows)],
+        'End node': [f'S{k}' for k in range(rows)],
+        'Flow [l/s]': [26.0, 18.0, 44.0, 24.0] * (rows // 4),
+        'Land elevation  [m]': 149.0,
+        'Channel bottom [m]': 147.5,
+        'Diameter [m]': [0.2, 0.2, 0.6, 0.25] * (rows // 4),
+        'pipe dip [m]': [1.8, 1.1, 2.85, 1.74] * (rows // 4),
+        'Length [m]': 10.0,
+        'slope [‰]': [50.56, 109.756098, 2.214022, 24.324324] * (rows // 4),
+    })
+
+
+def test_stream_marks_incomputable_rows_invalid(tmp_path):
+    df = inventory(4)
+    df.loc[0, 'Flow [l/s]'] = 0
+    df['Flow [l/s]'] = df['Flow [l/s]'].astype(object)
+    df.loc[1, 'Flow [l/s]'] = 'n/a'
+    df.loc[2, 'Diameter [m]'] = 0.16
+    df.loc[3, 'Diameter [m]'] = 0.315
+    path, output = tmp_path / 'pipes.csv', tmp_path / 'out.csv'
+    df.to_csv(path, index=False)
+    assert manage_file.stream_csv_data(str(path), str(output), chunksize=2) == 4
+    result = pd.read_csv(output)
+    assert result['slope is valid'].eq(0).all()
+    assert result.loc[[0, 1], 'v is valid'].eq(0).all()
+    assert result.loc[[0, 1], 'slope min [‰]'].isna().all()
+    assert result.loc[[2, 3], 'slope max [‰]'].isna().all()
+
+
+def test_stream_keeps_row_order_with_processes(tmp_path):
+    path = tmp_path / 'pipes.csv'
+    inventory(200).to_csv(path, index=False)
+    serial, parallel = tmp_path / 'serial.csv', tmp_path / 'parallel.csv'
+    manage_file.stream_csv_data(str(path), str(serial), chunksize=7)
+    manage_file.stream_csv_data(str(path), str(parallel), chunksize=7, processes=3)
+    result = pd.read_csv(parallel)
+    assert list(result['Lp.']) == list(range(1, 201))
+    assert result.equals(pd.read_csv(serial))
+
+
+def test_stream_output_can_be_streamed_again(tmp_path):
+    path, output, again = tmp_path / 'pipes.csv', tmp_path / 'out.csv', tmp_path / 'again.csv'
+    inventory(4).to_csv(path, index=False)
+    manage_file.stream_csv_data(str(path), str(output))
+    manage_file.stream_csv_data(str(output), str(again))
+    assert pd.read_csv(again).equals(pd.read_csv(output))
+
+
+def test_pipe_h_matches_calc_h():
+    q = np.array([0.0, 0.5, 26.0, 44.0, 180.0, 300.0])
+    d = np.array([0.2, 0.2, 0.2, 0.6, 0.5, 0.4])
+    i = np.array([5.0, 5.0, 50.56, 2.214022, 10.0, 3.0])
+    expected = [
+        np.nan if qk > pipe.calc_flow(dk, dk, ik) else pipe.calc_h(qk, dk, ik) for qk, dk, ik in zip(q.tolist(), d.tolist(), i.tolist())
+    ]
+    np.testing.assert_allclose(manage_file.calc_pipe_h(q, d, i), expected, atol=1e-9)
+
+
+def test_encoding_is_detected_from_a_prefix(tmp_path):
+    path = tmp_path / 'pipes.csv'
+    path.write_bytes('slope [‰]\n'.encode() + b'1\n' * 1000 + b'\xb0\n')
+    assert manage_file.detect_encoding(str(path)) == 'unicode_escape'
+    assert manage_file.detect_encoding(str(path), limit=100) == 'utf-8-sig'
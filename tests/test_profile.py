@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from rainwater_drainage_calculations import profile
+
+SETTINGS = pd.DataFrame({
+    'diameter': [0.16, 0.2, 0.315],
+    'min_slope': [6.25, 5.0, 3.174603],
+    'max_slope': [20.0, 20.0, 20.0],
+})
+
+
+def run(diameters=(0.2, 0.3), slopes=(50.0, 10.0)):
+    return pd.DataFrame({
+        'Start node': ['W1', 'S1', 'S2'],
+        'End node': ['S1', 'S2', 'S2'],
+        'Land elevation  [m]': [149.0, 148.9, 148.8],
+        'Channel bottom [m]': [147.5, 147.0, 145.0],
+        'Diameter [m]': list(diameters) + [0.3],
+        'Length [m]': [10.0, 20.0, np.nan],
+        'slope [‰]': list(slopes) + [np.nan],
+    })
+
+
+def test_pipes_without_slope_limits_are_invalid():
+    df = profile.regrade(run(slopes=(50.0, 48.0)), settings=SETTINGS)
+    assert df.loc[0, 'slope [‰]'] == 20.0
+    assert df.loc[0, 'slope is valid'] == 1
+    assert df.loc[1, 'slope [‰]'] == 48.0
+    assert df.loc[1, 'slope is valid'] == 0
+
+
+def test_diameters_missing_from_max_slope_table_are_invalid():
+    i_min, i_max = profile.slope_limits([0.16, 0.2])
+    assert i_min[0] == 0.16 ** -1 and np.isnan(i_max[0])
+    df = profile.regrade(run(diameters=(0.16, 0.3)))
+    assert df.loc[0, 'slope is valid'] == 0
+    assert df.loc[1, 'slope is valid'] == 1
+
+
+def test_regrade_does_not_end_below_receiver():
+    df = profile.regrade(run(), outlets={'S2': 147.3})
+    assert df.loc[1, 'Invert end [m]'] >= 147.3 - 1e-9
+    assert df['backfall'].sum() == 0
+    assert df.loc[0, 'Invert end [m]'] >= df.loc[1, 'Invert start [m]']
+
+
+def test_marker_row_fixes_receiver_invert():
+    df = run()
+    df.loc[2, 'Channel bottom [m]'] = 147.3
+    regraded = profile.regrade(df)
+    assert regraded.loc[1, 'Invert end [m]'] >= 147.3 - 1e-9
+    assert profile.calc_profile(df).loc[1, 'backfall'] == 1
+
+
+def test_drop_structure_is_flagged_above_max_drop():
+    df = run()
+    df.loc[1, 'Channel bottom [m]'] = 146.0
+    flagged = profile.calc_profile(df)
+    assert flagged.loc[1, 'Drop [m]'] == pytest.approx(1.0)
+    assert list(flagged['drop structure']) == [0, 1, 0]
+    assert profile.calc_profile(df, max_drop=1.5)['drop structure'].sum() == 0
+
+
+def test_cover_is_checked_at_both_ends():
+    df = profile.calc_profile(run())
+    assert list(df['cover is valid']) == [1, 1, 1]
+    shallow = run()
+    shallow.loc[0, 'Channel bottom [m]'] = 148.0
+    assert list(profile.calc_profile(shallow)['cover is valid']) == [0, 1, 1]
+
+
+def test_unknown_end_land_elevation_is_invalid():
+    # without the outlet row the land elevation at S2 is unknown
+    df = profile.calc_profile(run().iloc[:2])
+    assert np.isnan(df.loc[1, 'Land elevation end [m]'])
+    assert list(df['cover is valid']) == [1, 0]
@@ -0,0 +1,158 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from rainwater_drainage_calculations import rational_method
+
+INP = """[OPTIONS]
+FLOW_UNITS           {units}
+
+[SUBCATCHMENTS]
+;;Name  Rain Gage  Outlet  Area  %Imperv  Width  %Slope  CurbLen
+S1      1          J1      5     25       500    0.5     0
+
+[JUNCTIONS]
+J1      146.61     2.71    0     0     0
+J2      146.52     2.4     0     0     0
+J3      146.40     2.4     0     0     0
+
+[OUTFALLS]
+O4      146.20     FREE            NO
+
+[CONDUITS]
+C1      J1      J2      400     0.01    0     0     0     0
+C2      J2      J3      400     0.01    0     0     0     0
+C3      J3      O4      400     0.01    0     0     0     0
+
+[XSECTIONS]
+C1      CIRCULAR     1      0      0      0      1
+C2      RECT_CLOSED  1      1      0      0      1
+C3      CIRCULAR     0.16   0      0      0      1
+"""
+
+IDF = pd.DataFrame({"p=50%": [120.0, 90.0, 60.0, 40.0]}, index=[5, 10, 20, 60])
+
+
+@pytest.fixture
+def inp(tmp_path):
+    def write(units="CMS"):
+        path = tmp_path / "model.inp"
+        path.write_text(INP.format(units=units))
+        return str(path)
+    return write
+
+
+def test_intensity_follows_time_of_concentration(inp):
+    subcatchments = rational_method.read_subcatchments(inp())
+    wide = subcatchments.assign(**{"Width [m]": 5000.0})
+    tc, intensity = rational_method.calc_design_intensity(subcatchments, IDF)
+    tc_wide, intensity_wide = rational_method.calc_design_intensity(wide, IDF)
+    assert tc_wide.iloc[0, 0] < tc.iloc[0, 0]
+    assert intensity_wide.iloc[0, 0] > intensity.iloc[0, 0]
+    assert intensity.iloc[0, 0] == pytest.approx(np.interp(tc.iloc[0, 0], IDF.index, IDF["p=50%"]))
+
+
+def test_flow_is_routed_through_non_circular_conduits(inp):
+    path = inp()
+    subcatchments = rational_method.read_subcatchments(path)
+    conduits = rational_method.read_conduits(path)
+    q = rational_method.calc_peak_runoff(subcatchments, IDF)
+    flow = rational_method.accumulate_flows(conduits, subcatchments, q)
+    assert flow.loc["C3"].iloc[0] == pytest.approx(q.loc["S1"].iloc[0])
+    status = rational_method.prescreen(conduits, flow)
+    assert status.loc["C2"].iloc[0] == "not checked"
+    assert status.loc["C3"].iloc[0] == "overloaded"
+
+
+def test_us_units_are_converted(inp):
+    si = rational_method.read_subcatchments(inp("CMS"))
+    us = rational_method.read_subcatchments(inp("CFS"))
+    assert us["Area [ha]"].iloc[0] == pytest.approx(si["Area [ha]"].iloc[0] * rational_method.ACRE_TO_HA)
+    assert us["Width [m]"].iloc[0] == pytest.approx(si["Width [m]"].iloc[0] * rational_method.FT_TO_M)
+
+
+def test_long_trunk_is_accumulated():
+    n = 5000
+    conduits = pd.DataFrame(
+        {"From Node": [f"N{k}" for k in range(n)], "To Node": [f"N{k + 1}" for k in range(n)]},
+        index=[f"C{k}" for k in range(n)],
+    )
+    subcatchments = pd.DataFrame({"Outlet": ["N0", "N10"]}, index=["S1", "S2"])
+    q = pd.DataFrame({"a": [1.0, 2.0]}, index=subcatchments.index)
+    flow = rational_method.accumulate_flows(conduits, subcatchments, q)
+    assert flow.loc["C0", "a"] == 1.0
+    assert flow.loc[f"C{n - 1}", "a"] == 3.0
+
+
+NETWORK = """[OPTIONS]
+FLOW_UNITS           LPS
+LINK_OFFSETS         ELEVATION
+
+[SUBCATCHMENTS]
+S1      1          A       0.1     25       500    0.5     0
+S2      1          S1      0.1     25       500    0.5     0
+
+[JUNCTIONS]
+A       10.0       2     0     0     0
+B       9.8        2     0     0     0
+C       9.6        2     0     0     0
+D       9.6        2     0     0     0
+E       9.4        2     0     0     0
+F       9.2        2     0     0     0
+
+[OUTFALLS]
+G       8.0        FREE            NO
+
+[CONDUITS]
+AB      A       B       100     0.01    *     9.9   0     0
+BC      B       C       100     0.01    9.8   9.6   0     0
+CE      C       E       100     0.01    9.6   9.4   0     0
+DE      D       E       100     0.01    9.6   9.4   0     0
+EF      E       F       100     0.01    9.4   9.2   0     0
+
+[WEIRS]
+BD      B       D       TRANSVERSE   0.5   3.3   NO   0   0
+FG      F       G       TRANSVERSE   0     3.3   NO   0   0
+
+[XSECTIONS]
+AB      CIRCULAR     0.5      0      0      0      1
+BC      CIRCULAR     0.5      0      0      0      1
+CE      IRREGULAR    Transect1   0   0      0      1
+DE      CIRCULAR     0.5      0      0      0      1
+EF      CIRCULAR     0.5      0      0      0      1
+BD      RECT_OPEN    1        2      0      0
+FG      RECT_OPEN    1        2      0      0
+"""
+
+
+def test_network_with_regulators_and_irregular_sections(tmp_path):
+    path = tmp_path / "network.inp"
+    path.write_text(NETWORK)
+    conduits = rational_method.read_conduits(str(path))
+    assert np.isnan(conduits.loc["CE", "Diameter [m]"])
+    # elevation offsets, '*' is the node invert
+    assert conduits.loc["AB", "slope [‰]"] == pytest.approx(1.0)
+    assert conduits.loc["BC", "slope [‰]"] == pytest.approx(2.0)
+
+    links = rational_method.read_links(str(path))
+    assert set(links.index) == {"AB", "BC", "CE", "DE", "EF", "BD", "FG"}
+    subcatchments = rational_method.read_subcatchments(str(path))
+    q = pd.DataFrame({"a": [10.0, 5.0]}, index=subcatchments.index)
+    flow = rational_method.accumulate_flows(links, subcatchments, q)
+    # S2 drains to S1, the split at B leaves the flow downstream of it unknown
+    assert flow.loc["AB", "a"] == 15.0
+    assert flow.loc[["BC", "BD", "CE", "DE", "EF", "FG"], "a"].isna().all()
+
+    status = rational_method.prescreen_inp(str(path), IDF)
+    assert status.loc["AB"].iloc[0] == "valid"
+    assert (status.drop(index="AB") == "not checked").all().all()
+    assert list(rational_method.needs_simulation(status)) == [False, True, True, True, True]
+
+
+def test_classification_boundaries():
+    conduits = pd.DataFrame({"Diameter [m]": [0.3], "slope [‰]": [5.0]}, index=["C1"])
+    capacity = rational_method.calc_capacity(0.3, 5.0)
+    ratios = [0.799, 0.801, 1.199, 1.201]
+    flow = pd.DataFrame([[capacity * r for r in ratios]], index=["C1"], columns=ratios)
+    status = rational_method.prescreen(conduits, flow)
+    assert list(status.loc["C1"]) == ["valid", "borderline", "borderline", "overloaded"]